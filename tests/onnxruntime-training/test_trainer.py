@@ -19,7 +19,7 @@ import os
 import random
 import tempfile
 import unittest
-from itertools import chain
+from functools import lru_cache
 from typing import List, Optional
 from unittest.mock import Mock, patch
 
@@ -48,7 +48,7 @@ from transformers.training_args import OptimizerNames
 
 
 if is_torch_available():
-    pass
+    import torch
 
 import onnxruntime
 from parameterized import parameterized
@@ -57,7 +57,11 @@ from optimum.onnxruntime import ORTSeq2SeqTrainer, ORTSeq2SeqTrainingArguments,
 from optimum.onnxruntime.training_args import ORTOptimizerNames
 
 
-nltk.download("punkt")
+try:
+    # Recent versions of nltk load the Punkt parameters from `punkt_tab` instead of a pickle
+    from nltk.tokenize import PunktTokenizer
+except ImportError:
+    PunktTokenizer = None
 
 _ENCODERS_TO_TEST = {
     ("distilbert", "distilbert-base-uncased"),
@@ -75,7 +79,6 @@ _ENCODER_TASKS_DATASETS_CONFIGS = {
     "text-classification": {
         "dataset": ["glue", "sst2"],
         "metric": ["glue", "sst2"],
-        "data_collator": default_data_collator,
         "data_collator_class": DataCollatorWithPadding,
     },
 }
@@ -116,6 +119,24 @@ if is_torch_available():
 # default torch.distributed port
 DEFAULT_MASTER_PORT = "10999"
 
+# number of processes used to preprocess the datasets, only used for datasets with at least
+# `_MULTIPROCESSING_MIN_ROWS` rows as starting the workers costs more than tokenizing a few rows
+_NUM_PROC = min(8, os.cpu_count() or 1)
+_MULTIPROCESSING_MIN_ROWS = 10_000
+
+
+@lru_cache(maxsize=None)
+def _get_punkt_tokenizer():
+    punkt_resource = "punkt" if PunktTokenizer is None else "punkt_tab"
+    try:
+        nltk.data.find(f"tokenizers/{punkt_resource}")
+    except LookupError:
+        nltk.download(punkt_resource)
+
+    if PunktTokenizer is None:
+        return nltk.data.load("tokenizers/punkt/english.pickle")
+    return PunktTokenizer("english")
+
 
 def _get_models_to_test(model_list, task_list, excluded: Optional[List[str]] = None):
     models_to_test = []
@@ -129,22 +150,29 @@ def _get_models_to_test(model_list, task_list, excluded: Optional[List[str]] = N
     return sorted(models_to_test)
 
 
-def _get_data_collator(data_metric_config, tokenizer=None, model=None, training_args=None, label_pad_token_id=None):
+@lru_cache(maxsize=16)
+def _cached_data_collator(data_collator_class, tokenizer, pad_to_multiple_of=None, label_pad_token_id=None):
+    if data_collator_class is DataCollatorForSeq2Seq:
+        # The model is not passed to avoid keeping it alive, it creates the `decoder_input_ids` from the labels itself
+        return data_collator_class(
+            tokenizer,
+            label_pad_token_id=label_pad_token_id,
+            pad_to_multiple_of=pad_to_multiple_of,
+        )
+    return data_collator_class(tokenizer, pad_to_multiple_of=pad_to_multiple_of)
+
+
+def _get_data_collator(data_metric_config, tokenizer=None, label_pad_token_id=None):
     if "data_collator" in data_metric_config.keys():
         data_collator = data_metric_config["data_collator"]
     elif "data_collator_class" in data_metric_config.keys():
-        data_collator_class = data_metric_config["data_collator_class"]
-        if training_args is not None:
-            pad_to_multiple_of = 8 if training_args.fp16 else None
-        if data_collator_class is DataCollatorForSeq2Seq:
-            data_collator = data_collator_class(
-                tokenizer,
-                model=model,
-                label_pad_token_id=label_pad_token_id,
-                pad_to_multiple_of=pad_to_multiple_of,
-            )
-        else:
-            data_collator = data_collator_class(tokenizer, pad_to_multiple_of=8)
+        # Tensor Cores are used for sequence lengths multiple of 8, both in fp16 and in TF32
+        data_collator = _cached_data_collator(
+            data_metric_config["data_collator_class"],
+            tokenizer,
+            pad_to_multiple_of=8,
+            label_pad_token_id=label_pad_token_id,
+        )
     else:
         raise KeyError("You need to pass either `data_collator` or `data_collator_class` to create the data collator.")
 
@@ -167,18 +195,46 @@ def get_master_port(real_launcher=False):
     able to run both emulated launcher and normal launcher tests we need 2 distinct ports.
 
     This function will give the right port in the right context. For real launcher it'll give the
-    base port, for emulated launcher it'll give the base port + 1. In both cases a string is
-    returned.
+    base port, for emulated launcher it'll give the base port + 1. When the tests are distributed with
+    pytest-xdist, each worker gets its own pair of ports so that they don't collide. In all cases a
+    string is returned.
 
     Args:
         `real_launcher`: whether a real launcher is going to be used, or the emulated one
 
     """
 
-    master_port_base = os.environ.get("DS_TEST_PORT", DEFAULT_MASTER_PORT)
+    master_port_base = int(os.environ.get("DS_TEST_PORT", DEFAULT_MASTER_PORT))
+    worker_id = int(os.environ.get("PYTEST_XDIST_WORKER", "gw0")[2:])
+    master_port_base += 2 * worker_id
     if not real_launcher:
-        master_port_base = str(int(master_port_base) + 1)
-    return master_port_base
+        master_port_base += 1
+    return str(master_port_base)
+
+
+def enable_tf32(test_case):
+    """
+    Lets cuDNN pick the fastest kernels and allows TF32 Tensor Core math for the fp32 matmuls and convolutions. The
+    previous settings are restored when `test_case` is cleaned up, so that they do not leak into the other tests.
+    """
+
+    cudnn_benchmark = torch.backends.cudnn.benchmark
+    matmul_allow_tf32 = torch.backends.cuda.matmul.allow_tf32
+    cudnn_allow_tf32 = torch.backends.cudnn.allow_tf32
+    float32_matmul_precision = torch.get_float32_matmul_precision()
+
+    def restore():
+        torch.backends.cudnn.benchmark = cudnn_benchmark
+        torch.backends.cuda.matmul.allow_tf32 = matmul_allow_tf32
+        torch.backends.cudnn.allow_tf32 = cudnn_allow_tf32
+        torch.set_float32_matmul_precision(float32_matmul_precision)
+
+    test_case.addCleanup(restore)
+
+    torch.backends.cudnn.benchmark = True
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    torch.set_float32_matmul_precision("high")
 
 
 def get_ort_trainer(
@@ -190,6 +246,7 @@ def get_ort_trainer(
     max_train_samples=None,
     max_valid_samples=None,
     max_test_samples=None,
+    need_test_dataset=False,
     **kwargs,
 ):
     training_kwargs = load_and_prepare(task)(
@@ -200,6 +257,7 @@ def get_ort_trainer(
         max_train_samples=max_train_samples,
         max_valid_samples=max_valid_samples,
         max_test_samples=max_test_samples,
+        need_test_dataset=need_test_dataset,
         **kwargs,
     )
     test_dataset = training_kwargs.pop("test_dataset", None)
@@ -228,84 +286,103 @@ def load_and_prepare(task):
     return preprocess_mapping[task]
 
 
-def load_and_prepare_glue(model_name, data_metric_config, max_seq_length, padding="max_length", **kwargs):
-    # Prepare model
-    model = AutoModelForSequenceClassification.from_pretrained(model_name, attn_implementation="eager")
-    tokenizer = AutoTokenizer.from_pretrained(model_name)
+@lru_cache(maxsize=None)
+def _cached_tokenize(model_name, task, max_seq_length, dataset_config, metric_config, **kwargs):
+    """
+    Loads the tokenizer, dataset and metric for a given `(model_name, task)` pair and runs the preprocessing once,
+    so that the tokenized datasets can be shared by all the tests using the same configuration.
+
+    Returns:
+        `Tuple`: The train, validation and test datasets, the tokenizer and the metric.
+    """
+    tokenize_mapping = {
+        "text-classification": _tokenize_glue,
+        "token-classification": _tokenize_ner,
+        "text-generation": _tokenize_clm,
+        "text2text-generation": _tokenize_xsum,
+    }
+    return tokenize_mapping[task](model_name, dataset_config, metric_config, max_seq_length, **kwargs)
+
+
+def _load_dataset(
+    dataset_config, max_train_samples=None, max_valid_samples=None, max_test_samples=None, need_test_dataset=True
+):
+    dataset = load_dataset(*dataset_config)
+    if not need_test_dataset:
+        dataset.pop("test", None)
+
+    # Only keep the samples that are used, before running any preprocessing on them
+    return _select_samples(dataset, max_train_samples, max_valid_samples, max_test_samples)
+
+
+def _select_samples(dataset, max_train_samples=None, max_valid_samples=None, max_test_samples=None):
+    max_samples = {"train": max_train_samples, "validation": max_valid_samples, "test": max_test_samples}
+    for split, num_samples in max_samples.items():
+        if num_samples and split in dataset:
+            dataset[split] = dataset[split].select(range(num_samples))
+
+    return dataset
+
+
+def _get_num_proc(dataset):
+    return _NUM_PROC if sum(dataset.num_rows.values()) >= _MULTIPROCESSING_MIN_ROWS else None
+
+
+def _get_test_dataset(dataset, label_column=None):
+    if "test" not in dataset:
+        return None
+
+    test_dataset = dataset["test"]
+    if label_column is not None:
+        test_dataset = test_dataset.select_columns([c for c in test_dataset.column_names if c != label_column])
+    return test_dataset
+
+
+def _tokenize_glue(model_name, dataset_config, metric_config, max_seq_length, **kwargs):
+    tokenizer = AutoTokenizer.from_pretrained(model_name, use_fast=True)
+    # Batched tokenization relies on the fast (Rust) tokenizers, fail before loading the dataset if a slow one is picked
+    assert tokenizer.is_fast, f"Expected a fast tokenizer for {model_name}, got {tokenizer.__class__.__name__}."
 
     # Prepare dataset
-    dataset = load_dataset(*data_metric_config["dataset"])
-    metric = load(*data_metric_config["metric"])
+    dataset = _load_dataset(dataset_config, **kwargs)
+    metric = load(*metric_config)
 
     max_seq_length = min(max_seq_length, tokenizer.model_max_length)
 
     if tokenizer.pad_token is None:
         tokenizer.pad_token = tokenizer.eos_token
-        model.config.pad_token_id = model.config.eos_token_id
-
-    data_collator = _get_data_collator(data_metric_config)
 
+    # Padding is done per batch by the data collator
     def preprocess_function(examples):
         args = (examples["sentence"],)
-        return tokenizer(*args, padding=padding, max_length=max_seq_length, truncation=True)
+        return tokenizer(*args, max_length=max_seq_length, truncation=True)
 
-    encoded_dataset = dataset.map(preprocess_function, batched=True)
+    encoded_dataset = dataset.map(preprocess_function, batched=True, batch_size=1000, num_proc=_get_num_proc(dataset))
     train_dataset = encoded_dataset["train"]
     valid_dataset = encoded_dataset["validation"]
-    test_dataset = encoded_dataset["test"].remove_columns(["label"])
-
-    max_train_samples = kwargs.get("max_train_samples", None)
-    max_valid_samples = kwargs.get("max_valid_samples", None)
-    max_test_samples = kwargs.get("max_test_samples", None)
+    test_dataset = _get_test_dataset(encoded_dataset, "label")
 
-    if max_train_samples:
-        train_dataset = train_dataset.select(range(max_train_samples))
-    if max_valid_samples:
-        valid_dataset = valid_dataset.select(range(max_valid_samples))
-    if max_test_samples:
-        test_dataset = test_dataset.select(range(max_test_samples))
+    return train_dataset, valid_dataset, test_dataset, tokenizer, metric
 
-    def compute_metrics(eval_pred):
-        predictions = eval_pred.predictions[0] if isinstance(eval_pred.predictions, tuple) else eval_pred.predictions
-        predictions = np.argmax(predictions, axis=1)
-        return metric.compute(predictions=predictions, references=eval_pred.label_ids)
 
-    return {
-        "model": model,
-        "tokenizer": tokenizer,
-        "data_collator": data_collator,
-        "train_dataset": train_dataset,
-        "eval_dataset": valid_dataset,
-        "test_dataset": test_dataset,
-        "compute_metrics": compute_metrics,
-    }
-
-
-def load_and_prepare_ner(model_name, data_metric_config, max_seq_length, padding="max_length", **kwargs):
-    # Load dataset and metric
-    dataset = load_dataset(*data_metric_config["dataset"])
-    metric = load(*data_metric_config["metric"])
-    label_all_tokens = True
-    task = "ner"
-    label_list = dataset["train"].features[f"{task}_tags"].feature.names
-
-    # Prepare model
-    model = AutoModelForTokenClassification.from_pretrained(
-        model_name, num_labels=len(label_list), attn_implementation="eager"
-    )
+def _tokenize_ner(model_name, dataset_config, metric_config, max_seq_length, **kwargs):
     if model_name.split("-")[0] in {"gpt2", "roberta"}:
         tokenizer = AutoTokenizer.from_pretrained(model_name, use_fast=True, add_prefix_space=True)
     else:
         tokenizer = AutoTokenizer.from_pretrained(model_name, use_fast=True)
+    assert tokenizer.is_fast, f"Expected a fast tokenizer for {model_name}, got {tokenizer.__class__.__name__}."
+
+    # Load dataset and metric
+    dataset = _load_dataset(dataset_config, **kwargs)
+    metric = load(*metric_config)
+    label_all_tokens = True
+    task = "ner"
 
     # Prepare dataset
     max_seq_length = min(max_seq_length, tokenizer.model_max_length)
 
     if tokenizer.pad_token is None:
         tokenizer.pad_token = tokenizer.eos_token
-        model.config.pad_token_id = model.config.eos_token_id
-
-    data_collator = _get_data_collator(data_metric_config, tokenizer)
 
     def tokenize_and_align_labels(examples):
         tokenized_inputs = tokenizer(examples["tokens"], truncation=True, is_split_into_words=True)
@@ -329,35 +406,188 @@ def load_and_prepare_ner(model_name, data_metric_config, max_seq_length, padding
         tokenized_inputs["labels"] = labels
         return tokenized_inputs
 
-    tokenized_datasets = dataset.map(tokenize_and_align_labels, batched=True)
+    tokenized_datasets = dataset.map(
+        tokenize_and_align_labels, batched=True, batch_size=1000, num_proc=_get_num_proc(dataset)
+    )
     train_dataset = tokenized_datasets["train"]
     valid_dataset = tokenized_datasets["validation"]
-    test_dataset = tokenized_datasets["test"].remove_columns(["labels"])
+    test_dataset = _get_test_dataset(tokenized_datasets, "labels")
+
+    return train_dataset, valid_dataset, test_dataset, tokenizer, metric
+
+
+def _tokenize_clm(
+    model_name,
+    dataset_config,
+    metric_config,
+    max_seq_length,
+    max_train_samples=None,
+    max_valid_samples=None,
+    max_test_samples=None,
+    need_test_dataset=True,
+):
+    tokenizer = AutoTokenizer.from_pretrained(model_name, use_fast=True)
+    assert tokenizer.is_fast, f"Expected a fast tokenizer for {model_name}, got {tokenizer.__class__.__name__}."
+
+    # Load dataset and metric, the samples are blocks of `block_size` tokens so they are selected after grouping
+    dataset = _load_dataset(dataset_config, need_test_dataset=need_test_dataset)
+    metric = load(*metric_config)
+
+    # Prepare dataset
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+
+    column_names = dataset["train"].column_names
+    text_column_name = "text" if "text" in column_names else column_names[0]
+    block_size = tokenizer.model_max_length
+
+    # Texts are concatenated into blocks of `block_size` afterwards, so there is no need to pad them
+    def tokenize_function(examples):
+        output = tokenizer(examples[text_column_name])
+        return output
+
+    def group_texts(examples):
+        concatenated_examples = {
+            k: np.concatenate([np.asarray(t, dtype=np.int64) for t in examples[k]]) for k in examples.keys()
+        }
+        total_length = concatenated_examples[next(iter(concatenated_examples))].size
+        if total_length >= block_size:
+            total_length = (total_length // block_size) * block_size
+            result = {k: t[:total_length].reshape(-1, block_size).tolist() for k, t in concatenated_examples.items()}
+        else:
+            # Batches shorter than `block_size` are kept as a single block
+            result = {k: [t.tolist()] if total_length else [] for k, t in concatenated_examples.items()}
+        result["labels"] = [row[:] for row in result["input_ids"]]
+        return result
+
+    tokenized_dataset = dataset.map(
+        tokenize_function, batched=True, batch_size=1000, remove_columns=column_names, num_proc=_get_num_proc(dataset)
+    )
+    # Grouping is done in a single process, each shard would otherwise produce its own incomplete last block
+    lm_dataset = tokenized_dataset.map(
+        group_texts,
+        batched=True,
+        batch_size=1000,
+        load_from_cache_file=True,
+        desc=f"Grouping texts in chunks of {block_size}",
+    )
+    lm_dataset = _select_samples(lm_dataset, max_train_samples, max_valid_samples, max_test_samples)
+    train_dataset = lm_dataset["train"]
+    valid_dataset = lm_dataset["validation"]
+    test_dataset = _get_test_dataset(lm_dataset, "labels")
+
+    return train_dataset, valid_dataset, test_dataset, tokenizer, metric
+
+
+def _tokenize_xsum(model_name, dataset_config, metric_config, _, max_input_length=128, max_target_length=64, **kwargs):
+    tokenizer = AutoTokenizer.from_pretrained(model_name, use_fast=True)
+    assert tokenizer.is_fast, f"Expected a fast tokenizer for {model_name}, got {tokenizer.__class__.__name__}."
+
+    # Load dataset and metric
+    dataset = _load_dataset(dataset_config, **kwargs)
+    metric = load(*metric_config)
+
+    if model_name in ["t5-small", "t5-base", "t5-large", "t5-3b", "t5-11b"]:
+        prefix = "summarize: "
+    else:
+        prefix = ""
+
+    def preprocess_function(examples):
+        inputs = [prefix + doc for doc in examples["document"]]
+        tokenized_inputs = tokenizer(inputs, max_length=max_input_length, truncation=True)
+
+        # Setup the tokenizer for targets
+        with tokenizer.as_target_tokenizer():
+            labels = tokenizer(examples["summary"], max_length=max_target_length, truncation=True)
+
+        # Token ids fit in int32, which halves the size of the Arrow columns compared to the default int64
+        model_inputs = {k: [np.asarray(x, dtype=np.int32) for x in v] for k, v in tokenized_inputs.items()}
+        model_inputs["labels"] = [np.asarray(x, dtype=np.int32) for x in labels["input_ids"]]
+        return model_inputs
+
+    encoded_dataset = dataset.map(preprocess_function, batched=True, batch_size=1000, num_proc=_get_num_proc(dataset))
+    train_dataset = encoded_dataset["train"]
+    valid_dataset = encoded_dataset["validation"]
+    test_dataset = _get_test_dataset(encoded_dataset)
+
+    return train_dataset, valid_dataset, test_dataset, tokenizer, metric
+
+
+def load_and_prepare_glue(model_name, data_metric_config, max_seq_length, **kwargs):
+    train_dataset, valid_dataset, test_dataset, tokenizer, metric = _cached_tokenize(
+        model_name,
+        "text-classification",
+        max_seq_length,
+        tuple(data_metric_config["dataset"]),
+        tuple(data_metric_config["metric"]),
+        max_train_samples=kwargs.get("max_train_samples", None),
+        max_valid_samples=kwargs.get("max_valid_samples", None),
+        max_test_samples=kwargs.get("max_test_samples", None),
+        need_test_dataset=kwargs.get("need_test_dataset", True),
+    )
+
+    # Prepare model
+    model = AutoModelForSequenceClassification.from_pretrained(model_name, attn_implementation="eager")
+    if model.config.pad_token_id is None:
+        model.config.pad_token_id = tokenizer.pad_token_id
+
+    data_collator = _get_data_collator(data_metric_config, tokenizer)
+
+    def preprocess_logits_for_metrics(logits, labels):
+        if isinstance(logits, tuple):
+            logits = logits[0]
+        return logits.argmax(dim=-1)
+
+    def compute_metrics(eval_pred):
+        # The logits are already reduced to the predicted classes by `preprocess_logits_for_metrics`
+        predictions = eval_pred.predictions[0] if isinstance(eval_pred.predictions, tuple) else eval_pred.predictions
+        return metric.compute(predictions=predictions, references=eval_pred.label_ids)
 
-    max_train_samples = kwargs.get("max_train_samples", None)
-    max_valid_samples = kwargs.get("max_valid_samples", None)
-    max_test_samples = kwargs.get("max_test_samples", None)
+    return {
+        "model": model,
+        "tokenizer": tokenizer,
+        "data_collator": data_collator,
+        "train_dataset": train_dataset,
+        "eval_dataset": valid_dataset,
+        "test_dataset": test_dataset,
+        "compute_metrics": compute_metrics,
+        "preprocess_logits_for_metrics": preprocess_logits_for_metrics,
+    }
 
-    if max_train_samples:
-        train_dataset = train_dataset.select(range(max_train_samples))
-    if max_valid_samples:
-        valid_dataset = valid_dataset.select(range(max_valid_samples))
-    if max_test_samples:
-        test_dataset = test_dataset.select(range(max_test_samples))
+
+def load_and_prepare_ner(model_name, data_metric_config, max_seq_length, **kwargs):
+    train_dataset, valid_dataset, test_dataset, tokenizer, metric = _cached_tokenize(
+        model_name,
+        "token-classification",
+        max_seq_length,
+        tuple(data_metric_config["dataset"]),
+        tuple(data_metric_config["metric"]),
+        max_train_samples=kwargs.get("max_train_samples", None),
+        max_valid_samples=kwargs.get("max_valid_samples", None),
+        max_test_samples=kwargs.get("max_test_samples", None),
+        need_test_dataset=kwargs.get("need_test_dataset", True),
+    )
+    label_list = train_dataset.features["ner_tags"].feature.names
+    label_list_arr = np.array(label_list, dtype=object)
+
+    # Prepare model
+    model = AutoModelForTokenClassification.from_pretrained(
+        model_name, num_labels=len(label_list), attn_implementation="eager"
+    )
+    if model.config.pad_token_id is None:
+        model.config.pad_token_id = tokenizer.pad_token_id
+
+    data_collator = _get_data_collator(data_metric_config, tokenizer)
 
     def compute_metrics(p):
         predictions, labels = p
-        predictions = np.argmax(predictions, axis=2)
+        predictions = np.asarray(np.argmax(predictions, axis=2), dtype=np.int64)
+        labels = np.asarray(labels, dtype=np.int64)
 
         # Remove ignored index (special tokens)
-        true_predictions = [
-            [label_list[p] for (p, l) in zip(prediction, label) if l != -100]
-            for prediction, label in zip(predictions, labels)
-        ]
-        true_labels = [
-            [label_list[l] for (p, l) in zip(prediction, label) if l != -100]
-            for prediction, label in zip(predictions, labels)
-        ]
+        mask = labels != -100
+        true_predictions = [label_list_arr[p[m]].tolist() for p, m in zip(predictions, mask)]
+        true_labels = [label_list_arr[l[m]].tolist() for l, m in zip(labels, mask)]
 
         results = metric.compute(predictions=true_predictions, references=true_labels)
         return {
@@ -378,72 +608,38 @@ def load_and_prepare_ner(model_name, data_metric_config, max_seq_length, padding
     }
 
 
-def load_and_prepare_clm(model_name, data_metric_config, max_seq_length, padding="max_length", **kwargs):
-    # Load dataset and metric
-    dataset = load_dataset(*data_metric_config["dataset"])
-    metric = load(*data_metric_config["metric"])
+def load_and_prepare_clm(model_name, data_metric_config, max_seq_length, **kwargs):
+    train_dataset, valid_dataset, test_dataset, tokenizer, metric = _cached_tokenize(
+        model_name,
+        "text-generation",
+        max_seq_length,
+        tuple(data_metric_config["dataset"]),
+        tuple(data_metric_config["metric"]),
+        max_train_samples=kwargs.get("max_train_samples", None),
+        max_valid_samples=kwargs.get("max_valid_samples", None),
+        max_test_samples=kwargs.get("max_test_samples", None),
+        need_test_dataset=kwargs.get("need_test_dataset", True),
+    )
 
     # Prepare model
     model = AutoModelForCausalLM.from_pretrained(model_name, attn_implementation="eager")
-    tokenizer = AutoTokenizer.from_pretrained(model_name)
-
-    # Prepare dataset
-    max_seq_length = min(max_seq_length, tokenizer.model_max_length)
-
-    if tokenizer.pad_token is None:
-        tokenizer.pad_token = tokenizer.eos_token
-        model.config.pad_token_id = model.config.eos_token_id
+    if model.config.pad_token_id is None:
+        model.config.pad_token_id = tokenizer.pad_token_id
 
     data_collator = _get_data_collator(data_metric_config)
-    column_names = dataset["train"].column_names
-    text_column_name = "text" if "text" in column_names else column_names[0]
-    block_size = tokenizer.model_max_length
-
-    def tokenize_function(examples):
-        output = tokenizer(examples[text_column_name], padding=padding, max_length=max_seq_length)
-        return output
-
-    def group_texts(examples):
-        concatenated_examples = {k: list(chain(*examples[k])) for k in examples.keys()}
-        total_length = len(concatenated_examples[list(examples.keys())[0]])
-        if total_length >= block_size:
-            total_length = (total_length // block_size) * block_size
-        result = {
-            k: [t[i : i + block_size] for i in range(0, total_length, block_size)]
-            for k, t in concatenated_examples.items()
-        }
-        result["labels"] = result["input_ids"].copy()
-        return result
 
     def preprocess_logits_for_metrics(logits, labels):
         if isinstance(logits, tuple):
             logits = logits[0]
         return logits.argmax(dim=-1)
 
-    tokenized_dataset = dataset.map(tokenize_function, batched=True, remove_columns=column_names)
-    lm_dataset = tokenized_dataset.map(
-        group_texts,
-        batched=True,
-        desc=f"Grouping texts in chunks of {block_size}",
-    )
-    train_dataset = lm_dataset["train"]
-    valid_dataset = lm_dataset["validation"]
-    test_dataset = lm_dataset["test"].remove_columns(["labels"])
-
-    max_train_samples = kwargs.get("max_train_samples", None)
-    max_valid_samples = kwargs.get("max_valid_samples", None)
-    max_test_samples = kwargs.get("max_test_samples", None)
-    if max_train_samples:
-        train_dataset = train_dataset.select(range(max_train_samples))
-    if max_valid_samples:
-        valid_dataset = valid_dataset.select(range(max_valid_samples))
-    if max_test_samples:
-        test_dataset = test_dataset.select(range(max_test_samples))
-
     def compute_metrics(eval_pred):
+        # The logits are already reduced to the predicted tokens by `preprocess_logits_for_metrics`
         predictions = eval_pred.predictions[0] if isinstance(eval_pred.predictions, tuple) else eval_pred.predictions
-        predictions = np.argmax(predictions, axis=1)
-        return metric.compute(predictions=predictions, references=eval_pred.label_ids)
+        # The prediction at position i is for the token at position i + 1
+        predictions = predictions[:, :-1].reshape(-1)
+        labels = eval_pred.label_ids[:, 1:].reshape(-1)
+        return metric.compute(predictions=predictions, references=labels)
 
     return {
         "model": model,
@@ -458,54 +654,28 @@ def load_and_prepare_clm(model_name, data_metric_config, max_seq_length, padding
 
 
 def load_and_prepare_xsum(model_name, data_metric_config, _, **kwargs):
-    # Prepare model
-    model = AutoModelForSeq2SeqLM.from_pretrained(model_name, attn_implementation="eager")
-    tokenizer = AutoTokenizer.from_pretrained(model_name)
-
-    # Load dataset and metric
-    dataset = load_dataset(*data_metric_config["dataset"])
-    metric = load(*data_metric_config["metric"])
-
-    if model_name in ["t5-small", "t5-base", "t5-large", "t5-3b", "t5-11b"]:
-        prefix = "summarize: "
-    else:
-        prefix = ""
-
     max_input_length = kwargs.get("max_input_length", 128)
     max_target_length = kwargs.get("max_input_length", 64)
 
-    training_args = kwargs.get("training_args", None)
-    label_pad_token_id = tokenizer.pad_token_id
-    data_collator = _get_data_collator(
-        data_metric_config, tokenizer, model, training_args=training_args, label_pad_token_id=label_pad_token_id
+    train_dataset, valid_dataset, test_dataset, tokenizer, metric = _cached_tokenize(
+        model_name,
+        "text2text-generation",
+        None,
+        tuple(data_metric_config["dataset"]),
+        tuple(data_metric_config["metric"]),
+        max_input_length=max_input_length,
+        max_target_length=max_target_length,
+        max_train_samples=kwargs.get("max_train_samples", None),
+        max_valid_samples=kwargs.get("max_valid_samples", None),
+        max_test_samples=kwargs.get("max_test_samples", None),
+        need_test_dataset=kwargs.get("need_test_dataset", True),
     )
 
-    def preprocess_function(examples):
-        inputs = [prefix + doc for doc in examples["document"]]
-        model_inputs = tokenizer(inputs, max_length=max_input_length, truncation=True)
-
-        # Setup the tokenizer for targets
-        with tokenizer.as_target_tokenizer():
-            labels = tokenizer(examples["summary"], max_length=max_target_length, truncation=True)
-
-        model_inputs["labels"] = labels["input_ids"]
-        return model_inputs
-
-    encoded_dataset = dataset.map(preprocess_function, batched=True)
-    train_dataset = encoded_dataset["train"]
-    valid_dataset = encoded_dataset["validation"]
-    test_dataset = encoded_dataset["test"]
-
-    max_train_samples = kwargs.get("max_train_samples", None)
-    max_valid_samples = kwargs.get("max_valid_samples", None)
-    max_test_samples = kwargs.get("max_test_samples", None)
+    # Prepare model
+    model = AutoModelForSeq2SeqLM.from_pretrained(model_name, attn_implementation="eager")
 
-    if max_train_samples:
-        train_dataset = train_dataset.select(range(max_train_samples))
-    if max_valid_samples:
-        valid_dataset = valid_dataset.select(range(max_valid_samples))
-    if max_test_samples:
-        test_dataset = test_dataset.select(range(max_test_samples))
+    label_pad_token_id = tokenizer.pad_token_id
+    data_collator = _get_data_collator(data_metric_config, tokenizer, label_pad_token_id=label_pad_token_id)
 
     def compute_metrics(eval_pred):
         predictions, labels = eval_pred
@@ -517,14 +687,15 @@ def load_and_prepare_xsum(model_name, data_metric_config, _, **kwargs):
         decoded_labels = tokenizer.batch_decode(labels, skip_special_tokens=True)
 
         # Rouge expects a newline after each sentence
-        decoded_preds = ["\n".join(nltk.sent_tokenize(pred.strip())) for pred in decoded_preds]
-        decoded_labels = ["\n".join(nltk.sent_tokenize(label.strip())) for label in decoded_labels]
+        punkt_tokenizer = _get_punkt_tokenizer()
+        decoded_preds = ["\n".join(punkt_tokenizer.tokenize(pred.strip())) for pred in decoded_preds]
+        decoded_labels = ["\n".join(punkt_tokenizer.tokenize(label.strip())) for label in decoded_labels]
 
         result = metric.compute(predictions=decoded_preds, references=decoded_labels, use_stemmer=True)
 
         # Add mean generated length
-        prediction_lens = [np.count_nonzero(pred != tokenizer.pad_token_id) for pred in predictions]
-        result["gen_len"] = np.mean(prediction_lens)
+        prediction_lens = (predictions != tokenizer.pad_token_id).sum(axis=1)
+        result["gen_len"] = prediction_lens.mean()
 
         return {k: round(v, 4) for k, v in result.items()}
 
@@ -539,9 +710,10 @@ def load_and_prepare_xsum(model_name, data_metric_config, _, **kwargs):
     }
 
 
-class ORTTrainerIntegrationTest(unittest.TestCase):
+class ORTTrainerIntegrationTestMixin:
     def setUp(self):
         super().setUp()
+        enable_tf32(self)
         args = ORTTrainingArguments("..")
         master_port = get_master_port(real_launcher=False)
         self.dist_env_1_gpu = {
@@ -563,6 +735,8 @@ class ORTTrainerIntegrationTest(unittest.TestCase):
         self.warmup_steps = 10
         self.weight_decay = 0.01
 
+
+class ORTTrainerIntegrationTest(ORTTrainerIntegrationTestMixin, unittest.TestCase):
     @parameterized.expand(
         _get_models_to_test(_ENCODERS_TO_TEST, _ENCODER_TASKS_DATASETS_CONFIGS)
         + _get_models_to_test(_DECODERS_TO_TEST, _DECODER_TASKS_DATASETS_CONFIGS)
@@ -600,6 +774,8 @@ class ORTTrainerIntegrationTest(unittest.TestCase):
                 # trainer.predict(test_dataset)
                 gc.collect()
 
+
+class ORTTrainerIntegrationLabelSmoothingTest(ORTTrainerIntegrationTestMixin, unittest.TestCase):
     @slow
     @parameterized.expand(
         _get_models_to_test(_ENCODERS_TO_TEST, _ENCODER_TASKS_DATASETS_CONFIGS)
@@ -639,6 +815,8 @@ class ORTTrainerIntegrationTest(unittest.TestCase):
                 # trainer.predict(test_dataset)
                 gc.collect()
 
+
+class ORTTrainerIntegrationFP16Test(ORTTrainerIntegrationTestMixin, unittest.TestCase):
     @slow
     @parameterized.expand(
         _get_models_to_test(_ENCODERS_TO_TEST, _ENCODER_TASKS_DATASETS_CONFIGS)
@@ -681,30 +859,7 @@ class ORTTrainerIntegrationTest(unittest.TestCase):
 
 @slow
 @require_deepspeed
-class ORTTrainerIntegrationDeepSpeedTest(unittest.TestCase):
-    def setUp(self):
-        super().setUp()
-        args = ORTTrainingArguments("..")
-        master_port = get_master_port(real_launcher=False)
-        self.dist_env_1_gpu = {
-            "MASTER_ADDR": "localhost",
-            "MASTER_PORT": master_port,
-            "RANK": "0",
-            "LOCAL_RANK": "0",
-            "WORLD_SIZE": "1",
-        }
-        self.n_epochs = min(args.num_train_epochs, 1)
-        self.per_device_train_batch_size = min(args.per_device_train_batch_size, 2)
-        self.per_device_eval_batch_size = min(args.per_device_eval_batch_size, 2)
-
-        self.max_seq_length = 64
-        self.max_train_samples = 10
-        self.max_valid_samples = 5
-        self.max_test_samples = 5
-
-        self.warmup_steps = 10
-        self.weight_decay = 0.01
-
+class ORTTrainerIntegrationDeepSpeedTest(ORTTrainerIntegrationTestMixin, unittest.TestCase):
     @parameterized.expand(
         random.sample(
             _get_models_to_test(_ENCODERS_TO_TEST, _ENCODER_TASKS_DATASETS_CONFIGS)